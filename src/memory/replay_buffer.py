@@ -1,53 +1,88 @@
-from collections import deque
 import numpy as np
 
 
 class PrioritizedReplayBuffer:
-    def __init__(self, capacity, alpha=0.6):
+    def __init__(self, capacity, alpha=0.6, frame_shape=(84, 84, 1)):
         self.capacity = capacity
         self.alpha = alpha
-        self.buffer = []
+        # Structure-of-arrays storage: one preallocated array per transition
+        # field with a circular write pointer, so sampling is one vectorized
+        # fancy-index per field instead of a Python loop over tuples
+        # next_states are not stored: the successor of transition i is the
+        # frame pushed at slot i+1, so they are reconstructed on sample.
+        # Halves frame memory, the dominant buffer cost.
+        self.states = np.zeros((capacity,) + frame_shape, dtype=np.uint8)
+        self.actions = np.zeros((capacity,), dtype=np.int64)
+        self.rewards = np.zeros((capacity,), dtype=np.float32)
+        self.dones = np.zeros((capacity,), dtype=np.float32)
         self.priorities = np.zeros((capacity,), dtype=np.float32)
         self.pos = 0
+        self.size = 0
+        # Cached cumulative priorities**alpha, rebuilt lazily after pushes
+        # or priority updates so sampling is one searchsorted call
+        self._cumsum = None
+        self._cumsum_dirty = True
 
     def push(self, state, action, reward, next_state, done):
-        max_priority = self.priorities.max() if self.buffer else 1.0
-        if len(self.buffer) < self.capacity:
-            self.buffer.append((state, action, reward, next_state, done))
-        else:
-            self.buffer[self.pos] = (state, action, reward, next_state, done)
+        # next_state is accepted for API compatibility but not stored; it
+        # is the state of the next push (or masked out when done is set)
+        max_priority = self.priorities.max() if self.size else 1.0
+        self.states[self.pos] = state
+        self.actions[self.pos] = action
+        self.rewards[self.pos] = reward
+        self.dones[self.pos] = done
         self.priorities[self.pos] = max_priority
         self.pos = (self.pos + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+        self._cumsum_dirty = True
 
-    def sample(self, batch_size, beta=0.4):
-        if len(self.buffer) == self.capacity:
-            priorities = self.priorities
-        else:
-            priorities = self.priorities[:self.pos]
-        probabilities = priorities ** self.alpha
-        probabilities /= probabilities.sum()
+    def _cumulative_priorities(self):
+        if self._cumsum_dirty:
+            scaled = self.priorities[:self.size] ** self.alpha
+            # The newest transition's successor frame isn't in the buffer
+            # yet (once wrapped, its slot holds the oldest frame), so keep
+            # it out of the sampling distribution
+            scaled[(self.pos - 1) % self.capacity] = 0.0
+            self._cumsum = np.cumsum(scaled)
+            self._cumsum_dirty = False
+        return self._cumsum
 
-        indices = np.random.choice(len(self.buffer), batch_size, p=probabilities)
-        samples = [self.buffer[idx] for idx in indices]
+    def sample(self, batch_size, beta=0.4):
+        # Inverse-CDF sampling: one vectorized searchsorted over the cached
+        # cumulative priorities instead of normalizing the whole priority
+        # array and walking it per draw
+        cumsum = self._cumulative_priorities()
+        total = cumsum[-1]
+        u = np.random.uniform(0.0, total, size=batch_size)
+        indices = np.minimum(np.searchsorted(cumsum, u, side="right"), self.size - 1)
 
         # Compute importance-sampling weights
-        total = len(self.buffer)
-        weights = (total * probabilities[indices]) ** (-beta)
+        probabilities = self.priorities[indices] ** self.alpha / total
+        weights = (self.size * probabilities) ** (-beta)
         weights /= weights.max()
 
-        states, actions, rewards, next_states, dones = zip(*samples)
+        dones = self.dones[indices]
+        # Reconstruct successors from the circular states array; terminal
+        # transitions have no valid successor frame, so zero those rows
+        # (their done mask removes them from the Bellman target anyway)
+        next_states = self.states[(indices + 1) % self.capacity]
+        next_states[dones > 0.0] = 0
+
+        # Frames stay uint8 here; the agent casts to float on the device,
+        # so the H2D transfer moves 1 byte per pixel instead of 4.
         return (
-            np.array(states, dtype=np.float32),
-            np.array(actions, dtype=np.int64),
-            np.array(rewards, dtype=np.float32),
-            np.array(next_states, dtype=np.float32),
-            np.array(dones, dtype=np.float32),
+            self.states[indices],
+            self.actions[indices],
+            self.rewards[indices],
+            next_states,
+            dones,
             indices,
-            np.array(weights, dtype=np.float32),
+            weights.astype(np.float32),
         )
 
     def update_priorities(self, indices, priorities):
-        for idx, priority in zip(indices, priorities):
-            self.priorities[idx] = priority
+        self.priorities[np.asarray(indices)] = priorities
+        self._cumsum_dirty = True
+
     def __len__(self):
-        return len(self.buffer)
+        return self.size
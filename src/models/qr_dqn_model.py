@@ -25,13 +25,19 @@ class QRCNN(nn.Module):
         self.fc = nn.Linear(3136, 512)
         self.v = nn.Linear(512, num_actions * num_quantiles)
 
-    def forward(self, x):
+    def head(self, feat: torch.Tensor) -> torch.Tensor:
         """
-        x shape: (batch_size, in_channels=1, 84, 84)
+        Quantile head over flattened conv features.
+        feat shape: (batch_size, 3136)
         returns: (batch_size, num_actions, num_quantiles)
         """
-        x = self.features(x)
-        x = torch.relu(self.fc(x))
+        x = torch.relu(self.fc(feat))
         x = self.v(x)
-        x = x.view(-1, self.num_actions, self.num_quantiles)
-        return x
\ No newline at end of file
+        return x.view(-1, self.num_actions, self.num_quantiles)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        """
+        x shape: (batch_size, in_channels=1, 84, 84)
+        returns: (batch_size, num_actions, num_quantiles)
+        """
+        return self.head(self.features(x))
\ No newline at end of file